@@ -1,66 +1,416 @@
 import os
 import io
+import re
+import json
+import time
+import zlib
+import hashlib
+import asyncio
+import functools
+import atexit
+import signal
+import queue
+import contextlib
 import logging
+import logging.handlers
+from collections import OrderedDict, deque
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
-from google import genai
-from google.genai import types
-import base64
-from PIL import Image
-import requests
-from threading import Thread
-from flask import Flask
+import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
-import threading
 
-# Set up logging
+try:
+    import uvloop
+except ImportError:  # uvloop isn't available on Windows
+    uvloop = None
+
+try:
+    # SIMD-accelerated drop-in replacement for the stdlib codec
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# Load environment variables
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # Use WARNING in production to skip per-request logs
+
+# Set up logging; records are handed to a queue so file and console I/O happen on a
+# background thread instead of blocking the event loop
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler("bot.log"),
+    logging.StreamHandler()
+)
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger("GeminiBot")
 
-# Load environment variables
-load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PORT = int(os.getenv("PORT", 8080))  # Get port from environment variable or default to 8080
-
-# Set up Discord client with intents
-intents = discord.Intents.default()
+# Per-model Gemini quotas; unset or 0 leaves requests unthrottled
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 0))  # Gemini requests-per-minute quota
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", 0))  # Gemini tokens-per-minute quota
+
+# Set up Discord client with only the intents the bot uses, so the gateway doesn't push
+# typing, reaction, voice, emoji and other events we never handle
+intents = discord.Intents.none()
+intents.guilds = True
+intents.messages = True
 intents.message_content = True
-bot = commands.Bot(command_prefix=".", intents=intents)
+COMMAND_PREFIX = "."
+bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, chunk_guilds_at_startup=False)
 
-# Set up Gemini client
-genai_client = genai.Client(api_key=GEMINI_API_KEY)
+# Set up Gemini client; its async API shares one pooled connection, and the timeout
+# stops a stalled request from holding a channel's reply forever
+GEMINI_TIMEOUT = 120  # seconds; HttpOptions takes milliseconds
+
+@functools.lru_cache(maxsize=1)
+def get_genai_client():
+    """Create the Gemini client on first use, so startup and health checks don't wait for it."""
+    # google.genai takes around half a second to import, so it is loaded here rather than at startup
+    from google import genai
+    from google.genai import types
+
+    return genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT * 1000),
+    )
 
 # Track active channels for direct responses
 active_channels = set()
 
-# Create a simple Flask app for the web server
-app = Flask(__name__)
+# The bot's own user ID, cached in on_ready so on_message can compare plain ints
+bot_user_id = None
+
+# Gemini model used for text and image generation
+GEMINI_MODEL = "gemini-2.0-flash-preview-image-generation"
+
+# Cheaper, faster text-only model for short standalone questions
+GEMINI_FAST_MODEL = "gemini-2.0-flash-lite"
+
+# Response modalities each model supports
+MODEL_MODALITIES = {
+    GEMINI_MODEL: ("Text", "Image"),
+    GEMINI_FAST_MODEL: ("Text",),
+}
+
+# Prompts estimated below this many tokens can go to the fast model
+FAST_MODEL_TOKEN_LIMIT = 40
+
+# Words hinting that the user wants an image back, which only GEMINI_MODEL can produce
+IMAGE_REQUEST_WORDS = frozenset({
+    "image", "images", "picture", "pictures", "photo", "photos", "draw", "paint", "sketch",
+    "illustrate", "illustration", "render", "logo", "art", "wallpaper", "generate", "create", "edit",
+})
+
+# Messages in active channels shorter than this (without attachments) aren't sent to Gemini,
+# nor are ones starting with IGNORE_PREFIX, so users can talk around the bot
+MIN_PROMPT_LENGTH = 3
+IGNORE_PREFIX = "//"
+
+# Maximum length of a single Discord message
+DISCORD_MESSAGE_LIMIT = 2000
+
+# How far back from the limit to look for a newline or space to split a long message on
+SPLIT_LOOKBACK = 200
+
+# Markdown code fence; a chunk cut inside a code block is closed with CODE_FENCE_CLOSE and the next reopens it
+CODE_FENCE = "```"
+CODE_FENCE_CLOSE = "\n" + CODE_FENCE
+
+# Minimum seconds between edits while streaming a reply
+STREAM_FLUSH_INTERVAL = 1.5
+
+# Seconds a reply may take before a typing indicator is shown
+TYPING_DELAY = 1.5
+
+# File extensions for the image mime types Gemini returns
+MIME_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+# Leading bytes identifying the image formats above
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
 
 # Maximum turns of conversation history to keep
-HISTORY_LIMIT = 5
+HISTORY_LIMIT = 20
+
+# Maximum estimated tokens of history resent to Gemini per channel, so long replies can't bloat every prompt
+HISTORY_TOKEN_LIMIT = 6000
+
+# Once either limit is exceeded, history is compacted down to this fraction of it in one step
+HISTORY_COMPACT_RATIO = 0.5
+
+# Seconds allowed for downloading an attachment
+DOWNLOAD_TIMEOUT = 30
+
+# Rough prompt-token cost Gemini charges for an attached image
+IMAGE_TOKEN_ESTIMATE = 258
+
+# Most image attachments sent with one prompt; each can be up to MAX_IMAGE_BYTES while downloading
+MAX_IMAGE_ATTACHMENTS = 4
+
+# Largest attachment accepted, and the read size used while downloading it
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Attachments above this size go through the Gemini Files API, keeping requests under the 20MB inline cap
+INLINE_IMAGE_BYTES = 4 * 1024 * 1024
+
+# Attachments larger than this on either side are scaled down and re-encoded before being sent
+IMAGE_MAX_DIMENSION = 1024
+IMAGE_JPEG_QUALITY = 85
+
+# Image modes shrink_image re-encodes; others (e.g. 16-bit "I;16") convert badly and are sent as-is
+SHRINKABLE_IMAGE_MODES = frozenset({"RGB", "L", "P", "CMYK", "RGBA", "LA", "PA"})
+
+# Shared HTTP session for attachment downloads, created once the event loop is running
+http_session = None
+
+# Compacted turns are folded into a recap of the user's earlier prompts instead of being lost;
+# each prompt is clipped to SUMMARY_PROMPT_CHARS and the recap to SUMMARY_CHAR_LIMIT
+SUMMARY_PREFIX = "[Summary of earlier conversation] The user previously asked:"
+SUMMARY_PROMPT_CHARS = 200
+SUMMARY_CHAR_LIMIT = 1500
+
+# Seconds without activity after which a channel's history is moved out of memory onto disk,
+# where it is kept until the channel is used again or cleared
+HISTORY_IDLE_TTL = 3600
+
+# Directory where conversation history is persisted across restarts
+HISTORY_DIR = os.getenv("HISTORY_DIR", "data/history")
+
+# Number of channels whose history is kept in memory before spilling to disk
+HISTORY_CACHE_SIZE = 256
+
+class HistoryStore:
+    """Per-channel conversation history: an in-memory LRU backed by compressed files on disk.
+
+    Disk reads and writes run in worker threads; a lock keeps a channel from being loaded
+    while its previous history is still being written out.
+    """
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = asyncio.Lock()
+
+    async def get(self, channel_id, default=None):
+        """Return a channel's history, loading it from disk if it isn't in memory."""
+        history = self.entries.get(channel_id)
+        if history is not None:
+            self.entries.move_to_end(channel_id)
+            return history
+
+        async with self.lock:
+            # Another task may have loaded it while this one waited
+            history = self.entries.get(channel_id)
+            if history is None:
+                history = await asyncio.to_thread(self._load, channel_id)
+                if history is None:
+                    return default
+                await self._insert(channel_id, history)
+        return history
+
+    async def setdefault(self, channel_id, default):
+        """Return a channel's history, storing `default` for it if it has none."""
+        history = await self.get(channel_id)
+        if history is None:
+            async with self.lock:
+                history = self.entries.get(channel_id)
+                if history is None:
+                    history = default
+                    await self._insert(channel_id, history)
+        return history
+
+    async def delete(self, channel_id):
+        """Forget a channel's history in memory and on disk, returning whether there was any."""
+        async with self.lock:
+            in_memory = self.entries.pop(channel_id, None) is not None
+            on_disk = await asyncio.to_thread(self._remove, channel_id)
+        return in_memory or on_disk
+
+    async def spill(self, channel_id):
+        """Move a channel's history out of memory and onto disk."""
+        async with self.lock:
+            history = self.entries.pop(channel_id, None)
+            if history is not None:
+                await asyncio.to_thread(self._save, channel_id, history)
+
+    async def flush(self):
+        """Write every in-memory history to disk."""
+        async with self.lock:
+            for channel_id, history in list(self.entries.items()):
+                await asyncio.to_thread(self._save, channel_id, history)
+
+    async def _insert(self, channel_id, history):
+        # Callers hold self.lock
+        self.entries[channel_id] = history
+        while len(self.entries) > self.capacity:
+            evicted_id, evicted_history = self.entries.popitem(last=False)
+            await asyncio.to_thread(self._save, evicted_id, evicted_history)
+
+    def _path(self, channel_id):
+        return os.path.join(self.directory, f"{channel_id}.z")
+
+    def _save(self, channel_id, history):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file and swap it in, so an interrupted write can't truncate saved history
+            path = self._path(channel_id)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(zlib.compress(json.dumps(list(history)).encode("utf-8"), 1))
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error(f"Failed to save history for channel {channel_id}: {e}")
+
+    def _remove(self, channel_id):
+        try:
+            os.remove(self._path(channel_id))
+            return True
+        except FileNotFoundError:
+            return False
 
-# Initialize conversation history dictionary
-conversation_history = {}
+    def _load(self, channel_id):
+        try:
+            with open(self._path(channel_id), "rb") as f:
+                return deque(json.loads(zlib.decompress(f.read())))
+        except FileNotFoundError:
+            return None
+        except (OSError, zlib.error, ValueError) as e:
+            logger.error(f"Failed to load history for channel {channel_id}: {e}")
+            return None
 
-@app.route('/')
-def home():
-    return "Booted Jarvis!"
+# Initialize conversation history, holding a deque of messages per channel
+conversation_history = HistoryStore(HISTORY_DIR, HISTORY_CACHE_SIZE)
+
+# Last time each channel's history was updated
+history_last_used = {}
+
+# Number of standalone-prompt responses to cache, and how long they stay fresh (seconds)
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 3600
+
+# Cached responses for prompts asked without history or images, in least-recently-used order
+response_cache = OrderedDict()
+
+# Fraction of the Gemini quota we allow ourselves to use, leaving headroom against 429s
+RATE_LIMIT_MARGIN = 0.9
+
+class AsyncTokenBucket:
+    """Token bucket that makes callers wait for capacity instead of failing."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = max(1, int(capacity))
+        self.rate = self.capacity / period
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Wait until `amount` tokens are available, then consume them."""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+                logger.info("Rate limit reached, waiting %.2fs for capacity", wait_time)
+                await asyncio.sleep(wait_time)
+
+@functools.lru_cache(maxsize=None)
+def get_rate_limiters(model):
+    """Return a model's `(requests, tokens)` limiters; each model has its own quota, and a limiter is None when unset."""
+    return (
+        AsyncTokenBucket(GEMINI_RPM * RATE_LIMIT_MARGIN) if GEMINI_RPM > 0 else None,
+        AsyncTokenBucket(GEMINI_TPM * RATE_LIMIT_MARGIN) if GEMINI_TPM > 0 else None,
+    )
+
+@functools.lru_cache(maxsize=64)
+def get_generation_config(response_modalities=("Text", "Image")):
+    """Return a shared generation config for the given response modalities."""
+    from google.genai import types
+
+    return types.GenerateContentConfig(response_modalities=list(response_modalities))
+
+def estimate_tokens(messages):
+    """Roughly estimate the prompt tokens of a message list (about 4 characters per token)."""
+    chars = 0
+    for message in messages:
+        for part in message["parts"]:
+            chars += len(part.get("text", ""))
+    return chars // 4
+
+# Routes for the web server, which runs on the bot's own event loop
+routes = web.RouteTableDef()
+
+@routes.get('/')
+async def home(request):
+    return web.Response(text="Booted Jarvis!")
+
+@routes.get('/health')
+async def health(request):
+    # The server shares the bot's event loop, so report unhealthy once the bot has shut down
+    if bot.is_closed():
+        return web.Response(status=503, text="Discord connection closed")
+    return web.Response(text="OK")
+
+# Seconds an idle keep-alive connection is held open
+WEB_KEEPALIVE_TIMEOUT = 5
+
+# Create a simple web app for the web server
+app = web.Application()
+app.add_routes(routes)
 
-@app.route('/health')
-def health():
-    return "OK", 200
+@bot.event
+async def setup_hook():
+    global http_session
+    # Reuse pooled connections to Discord's CDN for every attachment download
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT),
+    )
+    evict_idle_history.start()
+
+@tasks.loop(minutes=10)
+async def evict_idle_history():
+    """Move the conversation history of channels that have been idle too long out of memory."""
+    cutoff = time.monotonic() - HISTORY_IDLE_TTL
+    idle_channels = [channel_id for channel_id, last_used in history_last_used.items() if last_used < cutoff]
+    for channel_id in idle_channels:
+        await conversation_history.spill(channel_id)
+        del history_last_used[channel_id]
+
+    if idle_channels:
+        logger.info(f"Moved idle conversation history to disk for {len(idle_channels)} channel(s)")
 
 @bot.event
 async def on_ready():
+    global bot_user_id
+    bot_user_id = bot.user.id
     logger.info(f'Jarvis is ready! Logged in as {bot.user}')
     # Log all available commands
     commands_list = [command.name for command in bot.commands]
@@ -76,104 +426,40 @@ async def on_ready():
 @bot.event
 async def on_message(message):
     # Ignore messages from the bot itself
-    if message.author == bot.user:
+    if message.author.id == bot_user_id:
         return
 
     channel_id = message.channel.id
 
-    # If the channel is activated and message doesn't start with a command prefix
-    if message.channel.id in active_channels and not message.content.startswith(bot.command_prefix):
+    # If the channel is activated and message doesn't start with a command prefix;
+    # most messages come from inactive channels, so test membership first
+    if channel_id in active_channels and not message.content.startswith(COMMAND_PREFIX) and should_answer(message):
         # Process as if it was an ask command
         ctx = await bot.get_context(message)
         prompt = message.content
 
         # Check if there are any image attachments
-        image_url = None
-        if message.attachments:
-            image_url = message.attachments[0].url
-            logger.info(f"Image attachment found in direct message: {image_url}")
+        image_urls = image_attachment_urls(message.attachments)
+        if image_urls:
+            logger.info("Image attachments found in direct message: %s", image_urls)
 
-        # Show typing indicator
-        async with ctx.typing():
+        # Show typing indicator if the reply takes a while
+        async with delayed_typing(ctx) as stop_typing:
             try:
                 # Get the conversation history for this channel
-                history = conversation_history.get(channel_id, [])
+                history = await conversation_history.get(channel_id, [])
 
+                # Stream text to Discord as it is generated
+                reply = StreamingReply(ctx.send, on_start=stop_typing)
                 # Generate the response with the history
-                response = await generate_content(prompt, image_url, history)
+                response = await generate_content(prompt, image_urls, history, on_text=reply.feed)
 
                 if not response:
                     await ctx.send("Failed to generate content. Check logs for details.")
                     return
 
-                # Process text and image responses
-                text_response = ""
-                image_files = []
-
-                # Access response content properly
-                for candidate in response.candidates:
-                    for part in candidate.content.parts:
-                        if hasattr(part, "text") and part.text:
-                            text_response += part.text
-                            logger.info(f"Got text response of length {len(part.text)}")
-
-                        # Handle image responses
-                        if hasattr(part, "inline_data") and part.inline_data:
-                            logger.info("Got image response")
-                            inline_data = part.inline_data
-
-                            # Log detailed information about the inline data
-                            logger.info(f"Inline data mime type: {inline_data.mime_type}")
-
-                            if hasattr(inline_data, "data") and inline_data.data:
-                                logger.info(f"Inline data present, length: {len(inline_data.data)}")
-
-                                # Check if the mime type is an image
-                                if inline_data.mime_type.startswith("image/"):
-                                    image_filename = f"generated_image_{len(image_files) + 1}.{inline_data.mime_type.split('/')[-1]}"
-
-                                    # Use the appropriate extension based on mime type
-                                    if "jpeg" in inline_data.mime_type or "jpg" in inline_data.mime_type:
-                                        image_filename = f"generated_image_{len(image_files) + 1}.jpg"
-                                    elif "png" in inline_data.mime_type:
-                                        image_filename = f"generated_image_{len(image_files) + 1}.png"
-                                    elif "webp" in inline_data.mime_type:
-                                        image_filename = f"generated_image_{len(image_files) + 1}.webp"
-                                    elif "gif" in inline_data.mime_type:
-                                        image_filename = f"generated_image_{len(image_files) + 1}.gif"
-
-                                    # Save the image
-                                    saved_file = save_image_from_base64(inline_data.data, image_filename)
-                                    if saved_file:
-                                        image_files.append(discord.File(saved_file))
-                                    else:
-                                        logger.error(f"Failed to save image with mime type: {inline_data.mime_type}")
-                            else:
-                                logger.warning("Inline data object has no 'data' attribute or it's empty")
-
-                # Send response to Discord
-                if text_response:
-                    # Split text if it's too long for Discord
-                    if len(text_response) > 2000:
-                        logger.info("Text response too long, splitting into chunks")
-                        chunks = [text_response[i:i + 2000] for i in range(0, len(text_response), 2000)]
-                        for i, chunk in enumerate(chunks):
-                            if i == 0 and image_files:  # Send first chunk with images
-                                await ctx.send(chunk, files=image_files)
-                                image_files = []  # Clear files to avoid sending them again
-                            else:
-                                await ctx.send(chunk)
-                    else:
-                        await ctx.send(text_response, files=image_files)
-                elif image_files:
-                    await ctx.send("Generated image(s):", files=image_files)
-                else:
-                    await ctx.send("No content was generated.")
-
-                # Update the conversation history
-                history.append({"role": "user", "parts": [{"text": prompt}]})
-                history.append({"role": "model", "parts": [{"text": text_response}]})  # Use the actual text_response
-                conversation_history[channel_id] = history[-HISTORY_LIMIT*2:]  # Keep history limit in mind
+                # Send the response to Discord and record the turn
+                await handle_gemini_response(reply, response, channel_id, prompt)
 
             except Exception as e:
                 logger.error(f"Error in direct message response: {e}")
@@ -182,97 +468,605 @@ async def on_message(message):
     # This line is critical - it must be called to process commands
     await bot.process_commands(message)
 
-async def generate_content(prompt, image_url=None, history=None):
-    """Generate content using Gemini model with optional image input and history."""
-    logger.info(f"Generating content with prompt: {prompt} and history: {history}")
+def should_answer(message):
+    """Decide whether a message in an active channel is worth a Gemini call."""
+    # Other bots' messages and explicit asides are left alone
+    if message.author.bot or message.content.startswith(IGNORE_PREFIX):
+        return False
+    # Acks like "ok" or a lone emoji can't produce a useful reply, unless they come with an image
+    return bool(image_attachment_urls(message.attachments)) or len(message.content.strip()) >= MIN_PROMPT_LENGTH
+
+def image_attachment_urls(attachments):
+    """Return the URLs of up to MAX_IMAGE_ATTACHMENTS image attachments, skipping files Gemini can't take as images."""
+    return [
+        attachment.url for attachment in attachments
+        if attachment.content_type and attachment.content_type.startswith("image/")
+    ][:MAX_IMAGE_ATTACHMENTS]
+
+@contextlib.asynccontextmanager
+async def delayed_typing(channel, delay=TYPING_DELAY):
+    """Show a typing indicator only if the wrapped block runs longer than `delay` seconds.
+
+    Yields a callable that stops the indicator early, e.g. once the reply starts appearing.
+    """
+    async def show_typing():
+        await asyncio.sleep(delay)
+        try:
+            async with channel.typing():
+                await asyncio.Event().wait()  # Keep typing until cancelled
+        except discord.HTTPException as e:
+            logger.warning(f"Failed to show typing indicator: {e}")
 
+    typing_task = asyncio.create_task(show_typing())
     try:
-        # Build the messages list, starting with the history
-        messages = []
-
-        if history:
-            messages.extend(history)
-
-        # Add the current user message
-        if image_url:
-            logger.info("Image URL provided, including in generation request")
-            image_data = await download_image(image_url)
-            if image_data:
-                # Create parts with both text and image
-                parts = [
-                    {"text": prompt},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": base64.b64encode(image_data).decode("utf-8")
-                        }
-                    }
-                ]
-                # Use the structured format for multimodal inputs
-                messages.append({"role": "user", "parts": parts})
+        yield typing_task.cancel
+    finally:
+        typing_task.cancel()
+
+def split_point(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Return where to cut `text` for one message, preferring a line break, then a space, near the limit."""
+    if len(text) <= limit:
+        return len(text)
+    start = limit - SPLIT_LOOKBACK
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, start, limit)
+        if cut != -1:
+            # Keep the separator with the earlier chunk so the next one starts cleanly
+            return cut + 1
+    return limit
+
+def open_code_fence(text):
+    """Return the fence (with any language tag) that reopens a code block left unclosed at the end of `text`, or None."""
+    fence = None
+    for line in text.splitlines():
+        line = line.strip()
+        # A line like ```code``` opens and closes its own block
+        if line.startswith(CODE_FENCE) and line.count(CODE_FENCE) % 2:
+            if fence:
+                fence = None
             else:
-                # Fallback to text-only if image download failed
-                messages.append({"role": "user", "parts": [{"text": prompt}]})
+                language = line[len(CODE_FENCE):].split()[:1]
+                # Only carry over something that looks like a language tag, not code written on the fence line
+                fence = CODE_FENCE + (language[0] if language and language[0].isidentifier() else "")
+    return fence
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Return (cut, close, reopen) for one message of `text`: send text[:cut] + close, then continue with reopen + text[cut:]."""
+    cut = split_point(text, limit)
+    if cut == len(text):
+        return cut, "", ""
+    fence = open_code_fence(text[:cut])
+    if fence is None:
+        return cut, "", ""
+    # Leave room to close the block within the limit
+    cut = split_point(text, limit - len(CODE_FENCE_CLOSE))
+    fence = open_code_fence(text[:cut])
+    if fence is None:
+        return cut, "", ""
+    return cut, CODE_FENCE_CLOSE, fence + "\n"
+
+def iter_message_chunks(text):
+    r"""Yield `text` in Discord-sized chunks split on line or word boundaries where possible.
+
+    Code blocks cut between chunks are closed and reopened so each chunk renders on its own.
+
+    >>> [len(chunk) for chunk in iter_message_chunks("a" * 1999)]
+    [1999]
+    >>> [len(chunk) for chunk in iter_message_chunks("a" * 2000)]
+    [2000]
+    >>> [len(chunk) for chunk in iter_message_chunks("a" * 2001)]
+    [2000, 1]
+    >>> [len(chunk) for chunk in iter_message_chunks("word " * 401)]
+    [2000, 5]
+    >>> chunks = list(iter_message_chunks("```py\n" + "x = 1\n" * 400 + "```"))
+    >>> [len(chunk) <= 2000 for chunk in chunks], [chunk.count("```") for chunk in chunks]
+    ([True, True], [2, 2])
+    >>> chunks[0].endswith("\n```"), chunks[1].startswith("```py\n")
+    (True, True)
+    """
+    start, reopen = 0, ""
+    while start < len(text):
+        window = reopen + text[start:start + DISCORD_MESSAGE_LIMIT + 1]
+        cut, close, next_reopen = split_message(window)
+        yield window[:cut] + close
+        start += cut - len(reopen)
+        reopen = next_reopen
+
+async def send_large_message(send, text, files=None):
+    """Send text in Discord-sized chunks, attaching any files to the first chunk."""
+    # Most replies fit in one message; skip building a chunk list for them
+    if len(text) <= DISCORD_MESSAGE_LIMIT:
+        await send(text, files=files or [])
+        return
+
+    logger.info("Text response too long (%d characters), splitting into chunks", len(text))
+
+    # Chunks go out one at a time, sliced as they are sent rather than copied into a list up front;
+    # concurrent sends can reach Discord out of order
+    chunks = iter_message_chunks(text)
+    await send(next(chunks), files=files or [])
+    for chunk in chunks:
+        await send(chunk)
+
+class StreamingReply:
+    """Show streamed text in Discord by editing a live message as tokens arrive."""
+
+    def __init__(self, send, on_start=None):
+        self.send = send
+        self.on_start = on_start  # Called just before the first message is sent
+        self.message = None  # Message currently being edited
+        self.content = ""  # Text currently shown in self.message
+        self.pending = []  # Text received but not yet shown
+        self.started = False  # Whether anything has been sent yet
+        self.last_flush = time.monotonic()
+
+    async def feed(self, text):
+        """Queue streamed text, pushing it to Discord at most every STREAM_FLUSH_INTERVAL seconds."""
+        self.pending.append(text)
+        if time.monotonic() - self.last_flush >= STREAM_FLUSH_INTERVAL:
+            await self.flush()
+
+    async def flush(self):
+        """Show pending text, continuing in a new message once the live one is full."""
+        text = self.content + "".join(self.pending)
+        self.pending.clear()
+        self.last_flush = time.monotonic()
+
+        try:
+            while len(text) > DISCORD_MESSAGE_LIMIT:
+                cut, close, reopen = split_message(text)
+                await self._show(text[:cut] + close)
+                self.message, self.content = None, ""
+                text = reopen + text[cut:]
+            if text:
+                await self._show(text)
+        except discord.HTTPException as e:
+            # A failed send or edit mustn't abort generation; keep the unshown text for the next flush
+            logger.warning(f"Failed to update streamed reply: {e}")
+            self.pending.append(text[len(self.content):])
+
+    async def _send(self, *args, **kwargs):
+        if not self.started:
+            self.started = True
+            if self.on_start:
+                self.on_start()
+        return await self.send(*args, **kwargs)
+
+    async def _show(self, text):
+        if self.message is None:
+            self.message = await self._send(text)
+        elif text != self.content:
+            await self.message.edit(content=text)
+        self.content = text
+
+    async def finish(self, text, files):
+        """Send whatever the stream hasn't shown yet, along with any generated files."""
+        if not self.started:
+            # Fast or cached replies never reached a flush; send them in one go with the files attached
+            if text:
+                await send_large_message(self._send, text, files)
+            elif files:
+                await self._send("Generated image(s):", files=files)
+            else:
+                await self._send("No content was generated.")
+            return
+
+        await self.flush()
+        if self.pending:
+            # The live message couldn't be edited; post the rest as new messages instead
+            await send_large_message(self._send, "".join(self.pending))
+            self.pending.clear()
+        if files:
+            await self._send("Generated image(s):", files=files)
+
+async def handle_gemini_response(reply, response, channel_id, prompt):
+    """Send a Gemini response's text and images through `reply` and record the turn in the channel's history."""
+    # Process text and image responses
+    text_parts = []
+    image_parts = []
+
+    # Access response content properly
+    for candidate in response.candidates:
+        for part in candidate.content.parts:
+            text = getattr(part, "text", None)
+            if text:
+                text_parts.append(text)
+                logger.debug("Got text response of length %d", len(text))
+
+            # Handle image responses
+            inline_data = getattr(part, "inline_data", None)
+            if not inline_data:
+                continue
+
+            mime_type = inline_data.mime_type or ""
+            logger.debug("Got image response with mime type: %s", mime_type)
+
+            data = getattr(inline_data, "data", None)
+            if not data:
+                logger.warning("Inline data object has no 'data' attribute or it's empty")
+                continue
+            logger.debug("Inline data present, length: %d", len(data))
+
+            # Check if the mime type is an image
+            if mime_type.startswith("image/"):
+                image_parts.append((mime_type, data))
+
+    # Decode images off the event loop, all at once; gather keeps them in response order
+    prepared = await asyncio.gather(*(
+        asyncio.to_thread(prepare_image_file, index, mime_type, data)
+        for index, (mime_type, data) in enumerate(image_parts, start=1)
+    ))
+    image_files = [image_file for image_file in prepared if image_file]
+
+    text_response = "".join(text_parts)
+
+    # Send the rest of the response to Discord
+    await reply.finish(text_response, image_files)
+
+    # Update the conversation history
+    await update_history(channel_id, prompt, text_response)
+    return text_response
+
+def prepare_image_file(index, mime_type, data):
+    """Decode one generated image into a discord.File, or return None if it can't be decoded."""
+    # Hand the decoded bytes straight to Discord, no temporary file
+    image_data = decode_image_data(data)
+    if not image_data:
+        logger.error(f"Failed to decode image with mime type: {mime_type}")
+        return None
+
+    # Trust a known mime type, otherwise identify the format from the bytes themselves
+    extension = MIME_EXTENSIONS.get(mime_type) or MIME_EXTENSIONS.get(sniff_image_mime(image_data), "bin")
+    return discord.File(io.BytesIO(image_data), filename=f"generated_image_{index}.{extension}")
+
+async def update_history(channel_id, prompt, text_response):
+    """Append a turn to the channel's history, compacting it only once it outgrows its limits."""
+    history = await conversation_history.setdefault(channel_id, deque())
+    history.extend((
+        {"role": "user", "parts": [{"text": prompt}]},
+        {"role": "model", "parts": [{"text": text_response}]},
+    ))
+
+    # Between compactions history is append-only, so consecutive prompts share a byte-identical
+    # prefix that Gemini can serve from its prompt cache. When over a limit, drop the oldest
+    # turns in one batch rather than one per request.
+    if len(history) > HISTORY_LIMIT * 2 or estimate_tokens(history) > HISTORY_TOKEN_LIMIT:
+        max_messages = int(HISTORY_LIMIT * HISTORY_COMPACT_RATIO) * 2
+        max_tokens = HISTORY_TOKEN_LIMIT * HISTORY_COMPACT_RATIO
+        compact_history(history, max_messages, max_tokens)
+        logger.info("Compacted history for channel %s to %d turn(s)", channel_id, len(history) // 2)
+
+    history_last_used[channel_id] = time.monotonic()
+
+def compact_history(history, max_messages, max_tokens):
+    """Drop the oldest turns until under the limits, keeping a short recap of them in their place."""
+    recap = []
+    while len(history) > 2 and (len(history) > max_messages or estimate_tokens(history) > max_tokens):
+        # Turns are stored as user/model pairs, so always drop both halves together
+        text = history.popleft()["parts"][0]["text"]
+        history.popleft()
+        if text.startswith(SUMMARY_PREFIX):
+            # Fold an earlier recap into the new one rather than nesting it
+            recap.extend(text[len(SUMMARY_PREFIX):].strip().splitlines())
         else:
-            # Text-only prompt
-            messages.append({"role": "user", "parts": [{"text": prompt}]})
-
-        # Make the API call with correct structure
-        response = genai_client.models.generate_content(
-            model="gemini-2.0-flash-preview-image-generation",
-            contents=messages,
-            config=types.GenerateContentConfig(
-                response_modalities=["Text", "Image"]
-            ),
+            recap.append("- " + " ".join(text.split())[:SUMMARY_PROMPT_CHARS])
+
+    # Keep the most recent prompts that fit
+    while len(recap) > 1 and sum(len(line) + 1 for line in recap) > SUMMARY_CHAR_LIMIT:
+        recap.pop(0)
+    if recap:
+        history.extendleft((
+            {"role": "model", "parts": [{"text": "Understood."}]},
+            {"role": "user", "parts": [{"text": SUMMARY_PREFIX + "\n" + "\n".join(recap)}]},
+        ))
+
+def digest_images(images):
+    """Return a tuple of SHA-256 digests identifying each `(bytes, mime_type)` image."""
+    return tuple(hashlib.sha256(image_data).digest() for image_data, _ in images)
+
+def normalize_prompt(prompt):
+    """Reduce a prompt to a cache key that ignores case, surrounding whitespace and one trailing question mark."""
+    # Internal whitespace is kept: indentation and line breaks change what code or YAML means.
+    # Other punctuation is kept too: "5!" (factorial) and "1, 2, 3..." mean something different without it.
+    key = prompt.strip().lower()
+    if key.endswith("?"):
+        key = key[:-1].rstrip()
+    return key
+
+def get_cached_response(key):
+    """Return the cached response for `key` if it is still fresh."""
+    entry = response_cache.get(key)
+    if entry is None:
+        return None
+
+    stored_at, response = entry
+    if time.monotonic() - stored_at > RESPONSE_CACHE_TTL:
+        del response_cache[key]
+        return None
+
+    response_cache.move_to_end(key)
+    return response
+
+def cache_response(key, response):
+    """Store a response, evicting the least recently used entries past the size limit."""
+    response_cache[key] = (time.monotonic(), response)
+    response_cache.move_to_end(key)
+    while len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+def has_generated_images(response):
+    """Check whether a response contains any inline image data."""
+    for candidate in response.candidates or []:
+        for part in candidate.content.parts or []:
+            if part.inline_data:
+                return True
+    return False
+
+def pick_model(prompt, history=None, image_urls=()):
+    """Route short, text-only, standalone prompts to the fast model and everything else to the image model."""
+    if image_urls or history or len(prompt) // 4 >= FAST_MODEL_TOKEN_LIMIT:
+        return GEMINI_MODEL
+    if IMAGE_REQUEST_WORDS.intersection(re.findall(r"[a-z]+", prompt.lower())):
+        return GEMINI_MODEL
+    return GEMINI_FAST_MODEL
+
+async def generate_content(prompt, image_urls=(), history=None, on_text=None):
+    """Generate content using Gemini model with optional image inputs and history, streaming text to `on_text`."""
+    from google.genai import types
+
+    logger.debug("Generating content with prompt: %s and history: %s", prompt, history)
+
+    uploads = []
+    try:
+        images = []
+        if image_urls:
+            logger.info("Image URLs provided, including in generation request")
+            # Download every attachment at once rather than one round trip after another
+            images = [image for image in await asyncio.gather(*(fetch_image(url) for url in image_urls)) if image]
+            if len(images) < len(image_urls):
+                logger.warning("Image download failed, leaving it out of the prompt")
+
+        model = pick_model(prompt, history, image_urls)
+
+        # Standalone prompts don't depend on the channel, so identical ones (with identical
+        # attachments) can share an answer; a prompt that is just "?" normalises to nothing
+        # and isn't cached
+        cache_key = None
+        normalized_prompt = normalize_prompt(prompt)
+        if not history and normalized_prompt:
+            # Hashing up to several MB per attachment is CPU-bound, so keep it off the event loop
+            image_digests = await asyncio.to_thread(digest_images, images) if images else ()
+            cache_key = (model, normalized_prompt, image_digests)
+            cached = get_cached_response(cache_key)
+            if cached is not None:
+                logger.info("Returning cached response")
+                return cached
+
+        # Wait for quota rather than letting a burst turn into 429s
+        request_limiter, token_limiter = get_rate_limiters(model)
+        if request_limiter:
+            await request_limiter.acquire()
+        if token_limiter:
+            await token_limiter.acquire(
+                estimate_tokens(history or []) + len(prompt) // 4 + IMAGE_TOKEN_ESTIMATE * len(images)
+            )
+
+        if not history and not images:
+            # Most first-turn prompts are plain text; the SDK accepts the bare string
+            contents = prompt
+        else:
+            # Build the messages list, starting with the history
+            contents = list(history or ())
+
+            # Add the current user message; large images are uploaded only once quota is granted
+            parts = [types.Part.from_text(text=prompt)]
+            parts.extend(await asyncio.gather(*(make_image_part(*image, uploads) for image in images)))
+            contents.append(types.Content(role="user", parts=parts))
+
+        logger.debug("Using model %s", model)
+
+        # Stream the response with the async client so text can be shown while the rest is generated
+        stream = await get_genai_client().aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=get_generation_config(MODEL_MODALITIES[model]),
+        )
+
+        parts = []
+        finish_reason = None
+        async for chunk in stream:
+            for candidate in chunk.candidates or []:
+                finish_reason = candidate.finish_reason or finish_reason
+                if not candidate.content or not candidate.content.parts:
+                    continue
+                for part in candidate.content.parts:
+                    parts.append(part)
+                    if on_text and part.text:
+                        await on_text(part.text)
+
+        # Merge the streamed chunks into one response for the callers
+        response = types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts), finish_reason=finish_reason)]
         )
 
         logger.info("Content generation successful")
+
+        # Only cache complete text answers; image requests should produce a fresh image each time,
+        # and empty or blocked answers shouldn't stick for the whole TTL
+        if (
+            cache_key is not None
+            and parts
+            and finish_reason == types.FinishReason.STOP
+            and not has_generated_images(response)
+        ):
+            cache_response(cache_key, response)
+
         return response
     except Exception as e:
         logger.error(f"Error generating content: {e}")
         return None
+    finally:
+        # Uploaded attachments are single-use; don't leave them in the project's file storage
+        if uploads:
+            await delete_uploads(uploads)
+
+async def delete_uploads(names):
+    """Delete files uploaded through the Files API, logging rather than raising on failure."""
+    results = await asyncio.gather(
+        *(get_genai_client().aio.files.delete(name=name) for name in names),
+        return_exceptions=True,
+    )
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to delete uploaded file {name}: {result}")
+
+async def make_image_part(image_data, mime_type, uploads):
+    """Build a request part for an image, uploading large ones through the Files API instead of inlining them.
+
+    Names of uploaded files are appended to `uploads` so the caller can delete them afterwards.
+    """
+    from google.genai import types
+
+    if len(image_data) > INLINE_IMAGE_BYTES:
+        logger.info("Uploading %d-byte image through the Files API", len(image_data))
+        try:
+            uploaded = await get_genai_client().aio.files.upload(
+                file=io.BytesIO(image_data),
+                config=types.UploadFileConfig(mime_type=mime_type),
+            )
+            uploads.append(uploaded.name)
+            return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+        except Exception as e:
+            logger.error(f"Failed to upload image, sending it inline instead: {e}")
+
+    # Pass the raw bytes; the SDK encodes them once for the wire
+    return types.Part.from_bytes(data=image_data, mime_type=mime_type)
+
+async def fetch_image(url):
+    """Download an image and return it as `(bytes, mime_type)`, shrunk if it is oversized."""
+    image = await download_image(url)
+    if not image:
+        return None
+
+    # Shrinking is CPU-bound, so keep it off the event loop
+    return await asyncio.to_thread(shrink_image, *image)
+
+def shrink_image(image_data, mime_type):
+    """Scale an oversized image down to IMAGE_MAX_DIMENSION and re-encode it, returning `(bytes, mime_type)`.
+
+    Opaque images become JPEG; images with transparency stay PNG so transparent pixels don't turn black.
+    """
+    # Animated GIFs would lose their frames, and small images gain nothing
+    if mime_type == "image/gif":
+        return image_data, mime_type
+
+    try:
+        # Pillow is optional here; without it attachments are sent as downloaded
+        from PIL import Image, ImageOps
+    except ImportError:
+        return image_data, mime_type
+
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        if max(image.size) <= IMAGE_MAX_DIMENSION or image.mode not in SHRINKABLE_IMAGE_MODES:
+            return image_data, mime_type
+
+        # Apply the EXIF orientation first, since re-encoding drops the tag and phone photos would arrive sideways
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            output_mime = "image/png"
+            image.save(output, "PNG", optimize=True)
+        else:
+            output_mime = "image/jpeg"
+            image.convert("RGB").save(output, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning(f"Failed to shrink image, sending the original: {e}")
+        return image_data, mime_type
+
+    if output.tell() >= len(image_data):
+        return image_data, mime_type
+    logger.debug("Shrank image from %d to %d bytes", len(image_data), output.tell())
+    return output.getvalue(), output_mime
 
 async def download_image(url):
-    """Download an image from a URL and return it as bytes."""
-    logger.info(f"Downloading image from {url}")
+    """Download an image from a URL and return it as `(bytes, mime_type)`."""
+    logger.info("Downloading image from %s", url)
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.content
-    except requests.RequestException as e:
+        async with http_session.get(url) as response:
+            response.raise_for_status()
+
+            # Stream the body so oversized attachments are rejected without being fully read
+            if (response.content_length or 0) > MAX_IMAGE_BYTES:
+                logger.error(f"Image too large to send to Gemini: {response.content_length} bytes")
+                return None
+            image_data = bytearray()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                image_data += chunk
+                if len(image_data) > MAX_IMAGE_BYTES:
+                    logger.error(f"Image too large to send to Gemini: over {MAX_IMAGE_BYTES} bytes")
+                    return None
+
+            # Trust the bytes over the CDN's header, which is often missing or generic
+            mime_type = sniff_image_mime(image_data) or response.content_type
+            if not mime_type.startswith("image/"):
+                mime_type = "image/jpeg"
+            return bytes(image_data), mime_type
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"Failed to download image: {e}")
         return None
 
-def save_image_from_base64(data, filename="generated_image.png"):
-    """Save image data (either base64 string or raw bytes) to a file."""
+def sniff_image_mime(data):
+    """Identify an image's mime type from its magic bytes, or return None if unrecognised."""
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    # WebP is a RIFF container with the format tag at offset 8
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def decode_malformed_base64(data):
+    """Decode base64 that failed strict decoding, tolerating a data URL prefix and missing padding."""
+    # Remove any potential data URL prefix
+    if ',' in data:
+        data = data.split(',', 1)[1]
+        logger.debug("Removed data URL prefix from base64 string")
+
+    # Fix padding issues if any
+    padding_needed = len(data) % 4
+    if padding_needed:
+        data += '=' * (4 - padding_needed)
+        logger.debug("Added %d padding characters to base64 string", 4 - padding_needed)
+
+    try:
+        return base64.b64decode(data)
+    except Exception as e:
+        logger.error(f"Failed to decode base64 string: {e}")
+        return None
+
+def decode_image_data(data):
+    """Decode image data (either base64 string or raw bytes) into raw bytes, kept in memory."""
     try:
-        logger.info(f"Attempting to save image data (type: {type(data)}, length: {len(data)})")
+        logger.debug("Attempting to decode image data (type: %s, length: %d)", type(data), len(data))
         
         # Determine if we're dealing with actual base64 string or raw bytes
         if isinstance(data, str):
             # This is a base64 string - decode it
-            logger.info("Processing as base64 string")
-            
-            # Fix padding issues if any
-            padding_needed = len(data) % 4
-            if padding_needed:
-                data += '=' * (4 - padding_needed)
-                logger.info(f"Added {4 - padding_needed} padding characters to base64 string")
-            
-            # Remove any potential data URL prefix
-            if ',' in data:
-                data = data.split(',', 1)[1]
-                logger.info("Removed data URL prefix from base64 string")
+            logger.debug("Processing as base64 string")
             
             try:
-                image_data = base64.b64decode(data)
-                logger.info(f"Successfully decoded base64 data to binary (size: {len(image_data)} bytes)")
-            except Exception as e:
-                logger.error(f"Failed to decode base64 string: {e}")
-                return None
+                # Gemini sends well-formed base64, so decode it as-is first
+                image_data = base64.b64decode(data, validate=True)
+            except ValueError:
+                image_data = decode_malformed_base64(data)
+                if image_data is None:
+                    return None
+            logger.debug("Successfully decoded base64 data to binary (size: %d bytes)", len(image_data))
         elif isinstance(data, bytes):
             # This appears to be raw binary data already
-            logger.info("Processing as raw binary data")
+            logger.debug("Processing as raw binary data")
             image_data = data
         else:
             logger.error(f"Unsupported data type: {type(data)}")
@@ -282,42 +1076,11 @@ def save_image_from_base64(data, filename="generated_image.png"):
         if len(image_data) < 100:
             logger.error(f"Data too small to be an image: {len(image_data)} bytes")
             return None
-            
-        # Now try to save the image using PIL
-        bytes_io = io.BytesIO(image_data)
-        bytes_io.seek(0)
-        
-        try:
-            # Try to open as an image
-            image = Image.open(bytes_io)
-            image_format = image.format
-            logger.info(f"Successfully identified image format: {image_format}")
-            
-            # If format is None, try to infer from filename or default to PNG
-            if not image_format:
-                image_format = filename.split('.')[-1].upper() if '.' in filename else 'PNG'
-                logger.info(f"No format detected, using extension from filename: {image_format}")
-            
-            # Save the image
-            image.save(filename, format=image_format)
-            logger.info(f"Image saved as {filename}")
-            return filename
-        except Exception as e:
-            logger.error(f"Failed to process as image with PIL: {e}")
-            
-            # Fallback to direct file save
-            try:
-                logger.info("Attempting direct file save as fallback")
-                with open(filename, 'wb') as f:
-                    f.write(image_data)
-                logger.info(f"Direct save successful: {filename}")
-                return filename
-            except Exception as e2:
-                logger.error(f"Direct file save failed: {e2}")
-                return None
-                
+
+        return image_data
+
     except Exception as e:
-        logger.error(f"Failed to save image: {e}")
+        logger.error(f"Failed to decode image: {e}")
         return None
 
 # Traditional prefix commands
@@ -327,103 +1090,30 @@ async def ask(ctx, *, prompt: str = None):
     if prompt is None:
         await ctx.send("Please provide a prompt. Example: `.ask What is the capital of France?`")
         return
-    logger.info(f"Received .ask command with prompt: {prompt}")
+    logger.info("Received .ask command with prompt: %s", prompt)
 
     channel_id = ctx.channel.id
     # Get the conversation history for this channel
-    history = conversation_history.get(channel_id, [])
+    history = await conversation_history.get(channel_id, [])
 
     # Check if there are any image attachments
-    image_url = None
-    if ctx.message.attachments:
-        image_url = ctx.message.attachments[0].url
-        logger.info(f"Image attachment found: {image_url}")
+    image_urls = image_attachment_urls(ctx.message.attachments)
+    if image_urls:
+        logger.info("Image attachments found: %s", image_urls)
 
-    # Show typing indicator
-    async with ctx.typing():
+    # Show typing indicator if the reply takes a while
+    async with delayed_typing(ctx) as stop_typing:
         try:
-            response = await generate_content(prompt, image_url, history)
+            # Stream text to Discord as it is generated
+            reply = StreamingReply(ctx.send, on_start=stop_typing)
+            response = await generate_content(prompt, image_urls, history, on_text=reply.feed)
 
             if not response:
                 await ctx.send("Failed to generate content. Check logs for details.")
                 return
 
-            # Process text and image responses
-            text_response = ""
-            image_files = []
-
-            # Access response content properly
-            for candidate in response.candidates:
-                for part in candidate.content.parts:
-                    if hasattr(part, "text") and part.text:
-                        text_response += part.text
-                        logger.info(f"Got text response of length {len(part.text)}")
-
-                    # Handle image responses
-                    if hasattr(part, "inline_data") and part.inline_data:
-                        logger.info("Got image response")
-                        inline_data = part.inline_data
-
-                        # Log detailed information about the inline data
-                        logger.info(f"Inline data mime type: {inline_data.mime_type}")
-
-                        if hasattr(inline_data, "data") and inline_data.data:
-                            logger.info(f"Inline data present, length: {len(inline_data.data)}")
-
-                            # Check if the mime type is an image
-                            if inline_data.mime_type.startswith("image/"):
-                                image_filename = f"generated_image_{len(image_files) + 1}.{inline_data.mime_type.split('/')[-1]}"
-
-                                # Use the appropriate extension based on mime type
-                                if "jpeg" in inline_data.mime_type or "jpg" in inline_data.mime_type:
-                                    image_filename = f"generated_image_{len(image_files) + 1}.jpg"
-                                elif "png" in inline_data.mime_type:
-                                    image_filename = f"generated_image_{len(image_files) + 1}.png"
-                                elif "webp" in inline_data.mime_type:
-                                    image_filename = f"generated_image_{len(image_files) + 1}.webp"
-                                elif "gif" in inline_data.mime_type:
-                                    image_filename = f"generated_image_{len(image_files) + 1}.gif"
-
-                                # Save the image
-                                saved_file = save_image_from_base64(inline_data.data, image_filename)
-                                if saved_file:
-                                    image_files.append(discord.File(saved_file))
-                                else:
-                                    logger.error(f"Failed to save image with mime type: {inline_data.mime_type}")
-                        else:
-                            logger.warning("Inline data object has no 'data' attribute or it's empty")
-
-            # Send response to Discord
-            if text_response:
-                # Split text if it's too long for Discord
-                if len(text_response) > 2000:
-                    logger.info("Text response too long, splitting into chunks")
-                    chunks = [text_response[i:i + 2000] for i in range(0, len(text_response), 2000)]
-                    for i, chunk in enumerate(chunks):
-                        if i == 0 and image_files:  # Send first chunk with images
-                            await ctx.send(chunk, files=image_files)
-                            image_files = []  # Clear files to avoid sending them again
-                        else:
-                            await ctx.send(chunk)
-                else:
-                    await ctx.send(text_response, files=image_files)
-            elif image_files:
-                await ctx.send("Generated image(s):", files=image_files)
-            else:
-                await ctx.send("No content was generated.")
-
-            # Update the conversation history
-            history.append({"role": "user", "parts": [{"text": prompt}]})
-            history.append({"role": "model", "parts": [{"text": text_response}]})  # Use the actual text_response
-            conversation_history[channel_id] = history[-HISTORY_LIMIT*2:]  # Keep history limit in mind
-
-            # Clean up temporary files
-            for file in image_files:
-                try:
-                    os.remove(file.filename)
-                    logger.info(f"Removed temporary file {file.filename}")
-                except Exception as e:
-                    logger.error(f"Error removing file {file.filename}: {e}")
+            # Send the response to Discord and record the turn
+            await handle_gemini_response(reply, response, channel_id, prompt)
 
         except Exception as e:
             logger.error(f"Error in ask command: {e}")
@@ -457,17 +1147,15 @@ async def deactivate(ctx):
 async def clear(ctx):
     """Clear the conversation history for the current channel."""
     channel_id = ctx.channel.id
-    if channel_id in conversation_history:
-        del conversation_history[channel_id]
+    if await conversation_history.delete(channel_id):
+        history_last_used.pop(channel_id, None)
         await ctx.send("Conversation history cleared for this channel.")
         logger.info(f"Conversation history cleared for channel {channel_id}")
     else:
         await ctx.send("No conversation history to clear in this channel.")
 
-@bot.command(name="guide", help="Display a guide on how to use the bot")
-async def guide(ctx):
-    """Display a guide on how to use the bot."""
-    guide_text = f"""
+# Help text for the .guide command
+GUIDE_TEXT = """
 ** Jarvis User Guide**
 
 Jarvis can generate text and images based on your prompts, and it can edit your images too.
@@ -492,6 +1180,7 @@ Jarvis can generate text and images based on your prompts, and it can edit your
 - When you use `.activate` or `/activate` in a channel, Jarvis will respond to all messages
 - You don't need to use any commands in activation mode
 - Great for extended conversations or quick questions
+- Start a message with `//` if you don't want Jarvis to reply to it
 - Use `.deactivate` or `/deactivate` to return to command-only mode
 
 **Tips:**
@@ -508,7 +1197,11 @@ Jarvis can generate text and images based on your prompts, and it can edit your
 `/ask Create an image of a futuristic city at night`
 `.ask [with image attached] Describe what you see in this image`
 """
-    await ctx.send(guide_text)
+
+@bot.command(name="guide", help="Display a guide on how to use the bot")
+async def guide(ctx):
+    """Display a guide on how to use the bot."""
+    await ctx.send(GUIDE_TEXT)
 
 # Slash commands
 @bot.tree.command(name="ask", description="Generate content using Jarvis")
@@ -517,116 +1210,39 @@ Jarvis can generate text and images based on your prompts, and it can edit your
 @app_commands.describe(prompt="Your question or prompt for Jarvis")
 async def slash_ask(interaction: discord.Interaction, prompt: str, attachment: discord.Attachment = None):
     """Slash command to generate content using Gemini."""
-    logger.info(f"Received /ask command with prompt: {prompt}")
+    logger.info("Received /ask command with prompt: %s", prompt)
     
     # Defer the response as AI generation might take time
     await interaction.response.defer(thinking=True)
     
     channel_id = interaction.channel_id
     # Get the conversation history for this channel
-    history = conversation_history.get(channel_id, [])
+    history = await conversation_history.get(channel_id, [])
 
     # Handle attachment if provided
-    image_url = None
-    if attachment:
-        image_url = attachment.url
-        logger.info(f"Image attachment found in slash command: {image_url}")
+    image_urls = image_attachment_urls([attachment] if attachment else [])
+    if image_urls:
+        logger.info("Image attachment found in slash command: %s", attachment.url)
 
     try:
-        response = await generate_content(prompt, image_url, history)
+        # Stream text to Discord as it is generated
+        reply = StreamingReply(interaction.followup.send)
+        response = await generate_content(prompt, image_urls, history, on_text=reply.feed)
 
         if not response:
             await interaction.followup.send("Failed to generate content. Check logs for details.")
             return
 
-        # Process text and image responses
-        text_response = ""
-        image_files = []
-
-        # Access response content properly
-        for candidate in response.candidates:
-            for part in candidate.content.parts:
-                if hasattr(part, "text") and part.text:
-                    text_response += part.text
-                    logger.info(f"Got text response of length {len(part.text)}")
-
-                # Handle image responses
-                if hasattr(part, "inline_data") and part.inline_data:
-                    logger.info("Got image response")
-                    inline_data = part.inline_data
-
-                    # Log detailed information about the inline data
-                    logger.info(f"Inline data mime type: {inline_data.mime_type}")
-
-                    if hasattr(inline_data, "data") and inline_data.data:
-                        logger.info(f"Inline data present, length: {len(inline_data.data)}")
-
-                        # Check if the mime type is an image
-                        if inline_data.mime_type.startswith("image/"):
-                            image_filename = f"generated_image_{len(image_files) + 1}.{inline_data.mime_type.split('/')[-1]}"
-
-                            # Use the appropriate extension based on mime type
-                            if "jpeg" in inline_data.mime_type or "jpg" in inline_data.mime_type:
-                                image_filename = f"generated_image_{len(image_files) + 1}.jpg"
-                            elif "png" in inline_data.mime_type:
-                                image_filename = f"generated_image_{len(image_files) + 1}.png"
-                            elif "webp" in inline_data.mime_type:
-                                image_filename = f"generated_image_{len(image_files) + 1}.webp"
-                            elif "gif" in inline_data.mime_type:
-                                image_filename = f"generated_image_{len(image_files) + 1}.gif"
-
-                            # Save the image
-                            saved_file = save_image_from_base64(inline_data.data, image_filename)
-                            if saved_file:
-                                image_files.append(discord.File(saved_file))
-                            else:
-                                logger.error(f"Failed to save image with mime type: {inline_data.mime_type}")
-                    else:
-                        logger.warning("Inline data object has no 'data' attribute or it's empty")
-
-        # Send response to Discord
-        if text_response:
-            # Split text if it's too long for Discord
-            if len(text_response) > 2000:
-                logger.info("Text response too long, splitting into chunks")
-                chunks = [text_response[i:i + 2000] for i in range(0, len(text_response), 2000)]
-                for i, chunk in enumerate(chunks):
-                    if i == 0 and image_files:  # Send first chunk with images
-                        await interaction.followup.send(chunk, files=image_files)
-                        image_files = []  # Clear files to avoid sending them again
-                    else:
-                        await interaction.followup.send(chunk)
-            else:
-                await interaction.followup.send(text_response, files=image_files)
-        elif image_files:
-            await interaction.followup.send("Generated image(s):", files=image_files)
-        else:
-            await interaction.followup.send("No content was generated.")
-
-       # Update the conversation history
-        history.append({"role": "user", "parts": [{"text": prompt}]})
-        history.append({"role": "model", "parts": [{"text": text_response}]})  # Use the actual text_response
-        conversation_history[channel_id] = history[-HISTORY_LIMIT*2:]  # Keep history limit in mind
-
-        # Clean up temporary files
-        for file in image_files:
-            try:
-                os.remove(file.filename)
-                logger.info(f"Removed temporary file {file.filename}")
-            except Exception as e:
-                logger.error(f"Error removing file {file.filename}: {e}")
+        # Send the response to Discord and record the turn
+        await handle_gemini_response(reply, response, channel_id, prompt)
 
     except Exception as e:
         logger.error(f"Error in slash ask command: {e}")
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
        
-@bot.tree.command(name="guide", description="Display a guide on how to use Jarvis")
-@app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
-@app_commands.user_install()
-async def slash_guide(interaction: discord.Interaction):
-    """Slash command to display a guide on how to use Jarvis."""
-    guide_text = f"""
+# Help text for the /guide command
+SLASH_GUIDE_TEXT = """
 ** Jarvis User Guide**
 
 Jarvis can generate text and images based on your prompts, and can edit images too.
@@ -652,18 +1268,49 @@ Jarvis can generate text and images based on your prompts, and can edit images t
 `/ask Create an image of a futuristic city at night`
 `/ask Add a hat on this robot, (with a robot image attached)`
 """
-    await interaction.response.send_message(guide_text)
 
-if __name__ == "__main__":
-    logger.info("Jarvis Booting...")
+@bot.tree.command(name="guide", description="Display a guide on how to use Jarvis")
+@app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
+@app_commands.user_install()
+async def slash_guide(interaction: discord.Interaction):
+    """Slash command to display a guide on how to use Jarvis."""
+    await interaction.response.send_message(SLASH_GUIDE_TEXT)
+
+async def main():
+    """Serve the web app and run the Discord bot on a single event loop."""
+    runner = web.AppRunner(app, keepalive_timeout=WEB_KEEPALIVE_TIMEOUT)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', PORT)
+    await site.start()
+    logger.info(f"Web server listening on port {PORT}")
 
-    # Start the Flask server in a separate thread
-    def run_flask():
-        app.run(debug=False, host='0.0.0.0', port=PORT)
+    # Hosts stop the process with SIGTERM; cancel main() so the cleanup below still runs
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass  # Not supported on Windows event loops
+
+    # Pool Discord REST connections and cache DNS instead of discord.py's default unbounded connector
+    bot.http.connector = aiohttp.TCPConnector(limit=100, limit_per_host=30, ttl_dns_cache=300)
 
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True  # Allow the main thread to exit even if the Flask thread is running
-    flask_thread.start()
+    try:
+        # Run the Discord bot
+        async with bot:
+            await bot.start(DISCORD_TOKEN)
+    except asyncio.CancelledError:
+        logger.info("Shutting down")
+    finally:
+        # Persist in-memory history so conversations survive a restart
+        await conversation_history.flush()
+        if http_session is not None:
+            await http_session.close()
+        await runner.cleanup()
 
-    # Run the Discord bot
-    bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    logger.info("Jarvis Booting...")
+
+    # Prefer uvloop's faster event loop when it is installed
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())